@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bs4 import BeautifulSoup
+import trafilatura
+from lxml import etree
+import fetcher
+from scraper import parse_html, extract_fields, extract_fields_bs4, count_hrefs, extract_main_content, EXTRACTION_MODES
+
+PARAGRAPH = "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.</p>"
+
+def build_page(index, paragraphs=40, links=200):
+    nav = "".join(f'<li><a href="/section/{index}/{i}">Section {i}</a></li>' for i in range(links))
+    external = "".join(f'<a href="https://example.org/{i}">External {i}</a>' for i in range(links // 10))
+    return (
+        "<!DOCTYPE html><html><head>"
+        f"<title>Benchmark page {index}</title>"
+        f'<meta name="description" content="Synthetic page {index} for benchmarking">'
+        "</head><body>"
+        f"<header><nav><ul>{nav}</ul></nav></header>"
+        f"<main><article><h1>Article {index}</h1>{PARAGRAPH * paragraphs}"
+        f"<h1>Appendix</h1>{PARAGRAPH * (paragraphs // 4)}</article></main>"
+        f"<footer>{external}</footer>"
+        "</body></html>"
+    )
+
+CORPUS = [build_page(i, paragraphs=20 + i * 10, links=100 + i * 100) for i in range(10)]
+
+def build_listing(index, items=60):
+    # Short, link-heavy text blocks: the kind of page where trafilatura's
+    # own extraction comes up short and the fallbacks get compared
+    cards = "".join(
+        f'<div class="card"><h2><a href="/item/{index}/{i}">Item {i}</a></h2><p>Short teaser {i} with a few words.</p></div>'
+        for i in range(items)
+    )
+    sidebar = "".join(f'<li><a href="/tag/{i}">Tag {i}</a></li>' for i in range(40))
+    return (
+        f"<html><head><title>Listing {index}</title></head><body>"
+        f"<div id=\"content\">{cards}</div><aside><ul>{sidebar}</ul></aside>"
+        f"<div class=\"comments\">{PARAGRAPH * 5}</div></body></html>"
+    )
+
+# Fixed mixed corpus for the extraction tiers: articles plus listings
+TIER_CORPUS = CORPUS + [build_listing(i, items=30 + i * 30) for i in range(5)]
+
+def double_parse(html):
+    # The pre-shared-tree pipeline: BeautifulSoup for the fields, then
+    # trafilatura re-parsing the raw string.
+    soup = BeautifulSoup(html, 'html.parser')
+    soup.title.string
+    soup.find("meta", attrs={"name": "description"})
+    [h1.text for h1 in soup.find_all("h1")]
+    [{"text": a.text, "href": a.get("href")} for a in soup.find_all("a", href=True)]
+    trafilatura.extract(html)
+
+def single_parse(html):
+    tree = parse_html(html)
+    extract_fields(tree)
+    trafilatura.extract(tree)
+
+def cpu_per_page(func, corpus, rounds=3):
+    start = time.process_time()
+    for _ in range(rounds):
+        for html in corpus:
+            func(html)
+    return (time.process_time() - start) / (rounds * len(corpus))
+
+def bench_single_parse():
+    before = cpu_per_page(double_parse, CORPUS)
+    after = cpu_per_page(single_parse, CORPUS)
+    print(f"double parse: {before * 1000:.1f} ms CPU/page")
+    print(f"single parse: {after * 1000:.1f} ms CPU/page")
+    print(f"saved: {(before - after) * 1000:.1f} ms CPU/page ({(1 - after / before) * 100:.0f}%)")
+
+def bench_field_engines():
+    lxml_time = cpu_per_page(lambda html: extract_fields(parse_html(html)), CORPUS)
+    bs4_time = cpu_per_page(extract_fields_bs4, CORPUS)
+    mismatches = [i for i, html in enumerate(CORPUS) if extract_fields(parse_html(html)) != extract_fields_bs4(html)]
+    print(f"bs4 fields:  {bs4_time * 1000:.1f} ms CPU/page")
+    print(f"lxml fields: {lxml_time * 1000:.1f} ms CPU/page (including parse)")
+    print(f"parity: {len(CORPUS) - len(mismatches)}/{len(CORPUS)} pages identical")
+
+def multi_scan(tree):
+    # One XPath scan per field, plus a second walk over the anchors for
+    # pages_count, as before the single-pass collector
+    title = etree.XPath('(//title)[1]')(tree)
+    description = etree.XPath('(//meta[@name="description"])[1]')(tree)
+    h1_tags = [str(h1.text_content()) for h1 in etree.XPath('//h1')(tree)]
+    links = [{"text": str(a.text_content()), "href": a.get('href')} for a in etree.XPath('//a[@href]')(tree)]
+    count_hrefs([a.get('href') for a in etree.XPath('//a[@href]')(tree)])
+    return title, description, h1_tags, links
+
+def bench_link_harvest():
+    pages = [parse_html(build_page(i, paragraphs=20, links=anchors)) for i, anchors in enumerate((5000, 10000, 20000))]
+    before = cpu_per_page(multi_scan, pages)
+    after = cpu_per_page(lambda tree: extract_fields(tree, "https://example.com/"), pages)
+    print(f"per-field scans:   {before * 1000:.1f} ms CPU/page (5k-20k anchors)")
+    print(f"single-pass fields: {after * 1000:.1f} ms CPU/page (5k-20k anchors)")
+
+def bench_extraction_modes():
+    for mode in EXTRACTION_MODES:
+        elapsed, length = 0.0, 0
+        for html in TIER_CORPUS:
+            tree = parse_html(html)
+            start = time.perf_counter()
+            length += len(extract_main_content(tree, extraction_mode=mode))
+            elapsed += time.perf_counter() - start
+        print(f"{mode:>8}: {elapsed / len(TIER_CORPUS) * 1000:.1f} ms/page, {length // len(TIER_CORPUS)} chars/page")
+
+CLIENT_PORTS = set()
+
+def start_h2_server(body, latency):
+    # Local TLS server speaking h2 and http/1.1, with a fixed per-request
+    # delay standing in for network latency. Needs hypercorn and trustme.
+    import trustme
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        CLIENT_PORTS.add(scope['client'][1])
+        await asyncio.sleep(latency)
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/html; charset=utf-8')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    ca = trustme.CA()
+    directory = tempfile.mkdtemp()
+    certfile, keyfile, cafile = (os.path.join(directory, name) for name in ('cert.pem', 'key.pem', 'ca.pem'))
+    server_cert = ca.issue_cert('localhost')
+    server_cert.cert_chain_pems[0].write_to_path(certfile)
+    server_cert.private_key_pem.write_to_path(keyfile)
+    ca.cert_pem.write_to_path(cafile)
+    config = Config()
+    config.bind = ['127.0.0.1:8443']
+    config.certfile, config.keyfile = certfile, keyfile
+    config.loglevel = 'ERROR'
+    # Runs until the process exits; a shutdown_trigger keeps hypercorn from
+    # installing signal handlers, which only work on the main thread
+    never = lambda: asyncio.Future()
+    threading.Thread(target=lambda: asyncio.run(serve(app, config, shutdown_trigger=never)), daemon=True).start()
+    time.sleep(1)
+    return 'https://localhost:8443', cafile
+
+def fetch_all(get, urls, concurrency):
+    def fetch(url):
+        response = get(url)
+        size = sum(len(chunk) for chunk in response.iter_content(65536))
+        response.close()
+        return size
+    with ThreadPoolExecutor(concurrency) as executor:
+        return sum(executor.map(fetch, urls))
+
+def bench_http2(requests_count=400, concurrency=50, latency=0.02):
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.ERROR)
+    if fetcher.httpx is None:
+        print("http2: skipped, httpx[http2] not installed")
+        return
+    try:
+        base_url, cafile = start_h2_server(CORPUS[0].encode(), latency)
+    except ImportError:
+        print("http2: skipped, hypercorn and trustme are needed for the test server")
+        return
+    urls = [f"{base_url}/page/{i}" for i in range(requests_count)]
+    sessions = fetcher.SessionPool(http2=False)
+    transport = fetcher.HTTP2Transport(verify=cafile)
+    for label, get in (
+        ("HTTP/1.1 pooled", lambda url: sessions.get(url, stream=True, verify=cafile, timeout=10)),
+        ("HTTP/2 multiplexed", lambda url: transport.get(url, timeout=10))
+    ):
+        CLIENT_PORTS.clear()
+        start = time.perf_counter()
+        fetch_all(get, urls, concurrency)
+        elapsed = time.perf_counter() - start
+        print(f"{label:>18}: {requests_count / elapsed:.0f} req/s over {len(CLIENT_PORTS)} connections ({concurrency} concurrent, {latency * 1000:.0f} ms server delay)")
+
+if __name__ == "__main__":
+    bench_single_parse()
+    bench_field_engines()
+    bench_link_harvest()
+    bench_extraction_modes()
+    bench_http2()
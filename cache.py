@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+# Size budgets for the webhook's result and failure caches. Entry sizes are
+# the length of their JSON encoding, which tracks the scraped text closely.
+CACHE_MAX_BYTES = int(os.environ.get('SCRAPER_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+NEGATIVE_CACHE_MAX_BYTES = int(os.environ.get('SCRAPER_NEGATIVE_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+# Expired entries are swept out at most this often, on writes
+SWEEP_INTERVAL = 60
+
+def entry_size(value):
+    # Sets (like a cache entry's field set) are encoded as lists
+    return len(json.dumps(value, default=list, ensure_ascii=False))
+
+class TTLCache:
+    """Thread-safe LRU cache with per-entry TTLs and a total size budget.
+
+    Writes evict the least recently used entries until the new one fits,
+    and every SWEEP_INTERVAL seconds drop all expired entries, so nothing
+    outlives its TTL just because it is never asked for again. Values are
+    stored as given; replace them with set() rather than mutating them, so
+    their size is measured again.
+
+    get() counts hits and misses; peek() is for internal lookups and touches
+    neither the counters nor the LRU order.
+    """
+
+    def __init__(self, max_bytes, sweep_interval=SWEEP_INTERVAL):
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        # key -> (expires, size, value), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._next_sweep = monotonic() + sweep_interval
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'rejected': 0}
+
+    def get(self, key, usable=None):
+        # usable(value), when given, decides whether a live entry can serve
+        # this lookup (an entry kept past its freshness, say); one that
+        # can't counts as a miss
+        now = monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None or (usable is not None and not usable(entry[2])):
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[2]
+
+    def peek(self, key):
+        with self._lock:
+            entry = self._live(key, monotonic())
+            return None if entry is None else entry[2]
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= now:
+            self._remove(key)
+            self._counters['expirations'] += 1
+            return None
+        return entry
+
+    def set(self, key, value, ttl):
+        size = entry_size(value)
+        now = monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                self._counters['rejected'] += 1
+                logger.warning(f"Not caching a {size} byte entry, over the {self.max_bytes} byte budget")
+                return False
+            if now >= self._next_sweep:
+                self._sweep(now)
+            while self._bytes + size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._counters['evictions'] += 1
+            self._entries[key] = (now + ttl, size, value)
+            self._bytes += size
+            return True
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._remove(key)
+            return entry[2]
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _sweep(self, now):
+        expired = [key for key, (expires, _, _) in self._entries.items() if expires <= now]
+        for key in expired:
+            self._remove(key)
+        self._counters['expirations'] += len(expired)
+        self._next_sweep = now + self.sweep_interval
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
@@ -1,7 +1,9 @@
 import os
 from flask import Flask, request, jsonify, send_from_directory
-from scraper import scrape_website, ScrapingError
-from validator import validate_input
+from scraper import scrape_website, run_many, Deadline, ScrapingError, DeadlineExceeded, FetchError, NotModified, UnsupportedContentError, FIELDS, DEFAULT_FIELDS, DEFAULT_EXTRACTION_MODE
+from validator import validate_input, validate_batch_input, validate_timeout
+from fetcher import fetch_stats, breaker_stats, proxy_stats
+from cache import TTLCache, CACHE_MAX_BYTES, NEGATIVE_CACHE_MAX_BYTES
 import logging
 from functools import wraps
 from time import time
@@ -29,9 +31,219 @@ if not WEBHOOK_KEY:
     print("WEBHOOK_KEY is not set.")
     raise ValueError("WEBHOOK_KEY is not set. Please set it using: set WEBHOOK_KEY=Your_Key")
 
-# Simple in-memory cache
-cache = {}
+# Bounded in-memory cache keyed by (url, extraction_mode). Entries record which
+# fields they hold, so a request for a subset of them is served from a wider
+# cached result, and the page's ETag/Last-Modified, so an expired entry can be
+# revalidated with a conditional request instead of a full re-scrape.
+# Fields that failed in a partial result expire sooner and are never
+# revalidated, so they get another chance; the entry's other fields keep
+# their full timeout. Entries with validators are kept for
+# REVALIDATION_WINDOW past their timeout for that conditional request; the
+# rest are dropped from memory once they expire.
+cache = TTLCache(CACHE_MAX_BYTES)
 CACHE_TIMEOUT = 3600  # 1 hour
+PARTIAL_CACHE_TIMEOUT = 300  # 5 minutes
+REVALIDATION_WINDOW = 86400  # 1 day
+
+def get_cached(cache_key, fields):
+    # Only fresh entries holding every requested field count as cache hits;
+    # the rest are misses even when kept around for revalidation
+    entry = cache.get(cache_key, lambda entry: (
+        time() - entry['timestamp'] < entry['timeout'] and set(fields) <= entry['fields']
+        and not (failed_fields(entry, fields) and time() >= entry['errors_expire'])
+    ))
+    if not entry:
+        return None
+    return cached_response(entry, fields)
+
+def failed_fields(entry, fields):
+    # The requested fields the cached result only holds an error for
+    return set(fields) & entry['data']['scraped_data'].get('errors', {}).keys()
+
+def cached_response(entry, fields):
+    scraped_data = {key: value for key, value in entry['data']['scraped_data'].items() if key not in FIELDS or key in fields}
+    if 'errors' in scraped_data:
+        errors = {field: error for field, error in scraped_data.pop('errors').items() if field in fields}
+        scraped_data['partial'] = bool(errors)
+        if errors:
+            scraped_data['errors'] = errors
+    return dict(entry['data'], scraped_data=scraped_data)
+
+def get_validators(cache_key, fields):
+    entry = cache.peek(cache_key)
+    if entry and entry['validators'] and set(fields) <= entry['fields'] and not failed_fields(entry, fields):
+        return entry['validators']
+    return None
+
+def store_cached(cache_key, entry):
+    keep = entry['timeout'] + (REVALIDATION_WINDOW if entry['validators'] else 0)
+    cache.set(cache_key, entry, keep - (time() - entry['timestamp']))
+
+def set_cached(cache_key, fields, response, validators=None):
+    errors = response['scraped_data'].get('errors', {})
+    errors_expire = time() + PARTIAL_CACHE_TIMEOUT if errors else None
+    entry = cache.peek(cache_key)
+    if entry and time() - entry['timestamp'] < entry['timeout']:
+        # Widen the fresh entry rather than replacing it; it keeps its
+        # original timestamp so no field outlives its timeout. New failures
+        # only shorten the life of the failed fields.
+        scraped_data = dict(entry['data']['scraped_data'])
+        errors = dict({field: error for field, error in scraped_data.pop('errors', {}).items() if field not in fields}, **errors)
+        truncated = scraped_data.get('truncated', False)
+        scraped_data.update(response['scraped_data'])
+        # Fields kept from the earlier scrape may come from a truncated page
+        # even when this one (a head-only fetch, say) was not
+        scraped_data['truncated'] = truncated or scraped_data.get('truncated', False)
+        scraped_data['partial'] = bool(errors)
+        scraped_data.pop('errors', None)
+        entry = dict(entry, data=dict(entry['data'], scraped_data=scraped_data), fields=entry['fields'] | set(fields))
+        if errors:
+            scraped_data['errors'] = errors
+            if errors_expire is not None:
+                entry['errors_expire'] = errors_expire
+        store_cached(cache_key, entry)
+        return
+    store_cached(cache_key, {
+        'data': response,
+        'fields': set(fields),
+        'validators': validators or {},
+        'timestamp': time(),
+        'timeout': CACHE_TIMEOUT,
+        'errors_expire': errors_expire
+    })
+
+def refresh_cached(cache_key, fields):
+    # A 304 confirmed the entry: restart its timeout and serve it
+    entry = cache.peek(cache_key)
+    if not entry:
+        return None
+    entry = dict(entry, timestamp=time())
+    store_cached(cache_key, entry)
+    return cached_response(entry, fields)
+
+# Failed scrapes are cached as well, keyed like the cache above, for a time
+# that depends on why they failed, so clients retrying a dead or missing URL
+# get the same answer without a new scrape. Processing errors and open
+# circuit breakers are not cached.
+negative_cache = TTLCache(NEGATIVE_CACHE_MAX_BYTES)
+NEGATIVE_CACHE_TIMEOUTS = {
+    'dns': 300,
+    '4xx': 300,
+    '5xx': 60,
+    'timeout': 30,
+    'connection': 30,
+    'unsupported': 3600
+}
+
+def failure_kind(error):
+    if isinstance(error, UnsupportedContentError):
+        return 'unsupported'
+    if not isinstance(error, FetchError):
+        return None
+    if error.kind == 'http' and error.status:
+        return '4xx' if error.status < 500 else '5xx'
+    return error.kind if error.kind in NEGATIVE_CACHE_TIMEOUTS else None
+
+def get_negative_cached(cache_key):
+    return negative_cache.get(cache_key)
+
+def set_negative_cached(cache_key, error, response, status_code):
+    kind = failure_kind(error)
+    if kind is None:
+        return
+    # 408/425/429 are transient like a 5xx; a Retry-After shortens the TTL
+    timeout = NEGATIVE_CACHE_TIMEOUTS['5xx' if kind == '4xx' and error.retryable else kind]
+    if getattr(error, 'retry_after', None) is not None:
+        timeout = min(timeout, error.retry_after)
+    negative_cache.set(cache_key, {
+        'data': response,
+        'status_code': status_code,
+        'kind': kind
+    }, timeout)
+
+def failure_response(cache_key, error, status_code):
+    response = {"error": str(error), "status": "failed"}
+    set_negative_cached(cache_key, error, response, status_code)
+    return response, status_code, {}
+
+def request_deadline(data):
+    # The caller's own timeout, from the payload or the X-Request-Timeout
+    # header (the shorter wins), bounds all the work done for this request.
+    # Returns (deadline or None, error message or None).
+    timeouts = [data['timeout']] if 'timeout' in data else []
+    if 'X-Request-Timeout' in request.headers:
+        try:
+            header_timeout = float(request.headers['X-Request-Timeout'])
+        except ValueError:
+            return None, "'X-Request-Timeout' must be a number of seconds."
+        validation_result = validate_timeout(header_timeout)
+        if validation_result:
+            return None, validation_result
+        timeouts.append(header_timeout)
+    return (Deadline('request', min(timeouts)) if timeouts else None), None
+
+def scrape_and_cache(website_url, fields, extraction_mode, deadline=None):
+    # Serves one URL from the caches or by scraping it, and keeps the caches
+    # up to date. Returns (response body, status code, extra headers).
+    cache_key = (website_url, extraction_mode)
+    try:
+        # Check cache first
+        cached = get_cached(cache_key, fields)
+        if cached:
+            print(f"Returning cached data for: {website_url}")
+            return cached, 200, {}
+
+        failed = get_negative_cached(cache_key)
+        if failed:
+            print(f"Returning cached {failed['kind']} failure for: {website_url}")
+            return dict(failed['data'], cached=True), failed['status_code'], {}
+
+        print(f"Scraping website: {website_url}")
+        try:
+            scraped_data = scrape_website(website_url, fields=fields, extraction_mode=extraction_mode, validators=get_validators(cache_key, fields), deadline=deadline)
+        except NotModified:
+            cached = refresh_cached(cache_key, fields)
+            if cached:
+                print(f"Not modified, extending cached data for: {website_url}")
+                return cached, 200, {}
+            print(f"Cached data for {website_url} was evicted while revalidating, scraping again")
+            scraped_data = scrape_website(website_url, fields=fields, extraction_mode=extraction_mode, deadline=deadline)
+        validators = scraped_data.pop('validators', None)
+
+        response = {
+            "status": "success",
+            "scraped_data": scraped_data,
+            "message": "Website successfully scraped."
+        }
+
+        # Update cache, unless fields are missing only because this caller's
+        # deadline ran out; other callers may have time to spare
+        if scraped_data.get('errors') and deadline is not None and deadline.expired():
+            print(f"Not caching partial data cut short by the request deadline for: {website_url}")
+        else:
+            set_cached(cache_key, fields, response, validators)
+        negative_cache.pop(cache_key)
+
+        print("Scraping successful")
+        return response, 200, {}
+
+    except UnsupportedContentError as e:
+        print(f"Scraping rejected: {str(e)}")
+        return failure_response(cache_key, e, 422)
+
+    except DeadlineExceeded as e:
+        print(f"Scraping timed out: {str(e)}")
+        return {"error": str(e), "status": "failed"}, 504, {}
+
+    except FetchError as e:
+        print(f"Scraping failed: {str(e)}")
+        if e.kind == 'circuit_open':
+            return {"error": str(e), "status": "failed"}, 503, {"Retry-After": str(max(1, round(e.retry_after)))}
+        return failure_response(cache_key, e, 500)
+
+    except ScrapingError as e:
+        print(f"Scraping failed: {str(e)}")
+        return {"error": str(e), "status": "failed"}, 500, {}
 
 # Rate limiting
 RATE_LIMIT = 10  # requests
@@ -52,6 +264,14 @@ def rate_limit(func):
         return func(*args, **kwargs)
     return wrapper
 
+def require_webhook_key(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if request.headers.get('X-Webhook-Key') != WEBHOOK_KEY:
+            return jsonify({"error": "Invalid webhook key"}), 401
+        return func(*args, **kwargs)
+    return wrapper
+
 @app.route('/webhook', methods=['GET', 'POST'])
 @rate_limit
 def webhook():
@@ -78,34 +298,61 @@ def webhook():
         return jsonify({"error": validation_result}), 400
 
     website_url = data['website_url']
-    
-    try:
-        # Check cache first
-        if website_url in cache and time() - cache[website_url]['timestamp'] < CACHE_TIMEOUT:
-            print(f"Returning cached data for: {website_url}")
-            return jsonify(cache[website_url]['data']), 200
+    fields = [field for field in FIELDS if field in data.get('fields', DEFAULT_FIELDS)]
+    extraction_mode = data.get('extraction_mode', DEFAULT_EXTRACTION_MODE)
+    deadline, validation_result = request_deadline(data)
+    if validation_result:
+        return jsonify({"error": validation_result}), 400
 
-        print(f"Scraping website: {website_url}")
-        scraped_data = scrape_website(website_url)
+    response, status_code, headers = scrape_and_cache(website_url, fields, extraction_mode, deadline)
+    return jsonify(response), status_code, headers
 
-        response = {
-            "status": "success",
-            "scraped_data": scraped_data,
-            "message": "Website successfully scraped."
-        }
-        
-        # Update cache
-        cache[website_url] = {
-            'data': response,
-            'timestamp': time()
-        }
+@app.route('/webhook/batch', methods=['POST'])
+@rate_limit
+@require_webhook_key
+def webhook_batch():
+    # Scrapes several URLs concurrently on the async engine, each through the
+    # same caches as /webhook. Results keep the order of 'website_urls'.
+    data = request.json
+    validation_result = validate_batch_input(data)
+    if validation_result:
+        print(f"Validation error: {validation_result}")
+        return jsonify({"error": validation_result}), 400
 
-        print("Scraping successful")
-        return jsonify(response), 200
+    website_urls = list(dict.fromkeys(data['website_urls']))
+    fields = [field for field in FIELDS if field in data.get('fields', DEFAULT_FIELDS)]
+    extraction_mode = data.get('extraction_mode', DEFAULT_EXTRACTION_MODE)
+    deadline, validation_result = request_deadline(data)
+    if validation_result:
+        return jsonify({"error": validation_result}), 400
 
-    except ScrapingError as e:
-        print(f"Scraping failed: {str(e)}")
-        return jsonify({"error": str(e), "status": "failed"}), 500
+    print(f"Scraping batch of {len(website_urls)} websites")
+    outcomes = dict(zip(website_urls, run_many(website_urls, scrape_and_cache, fields, extraction_mode, deadline)))
+    results = []
+    for website_url in data['website_urls']:
+        outcome = outcomes[website_url]
+        if isinstance(outcome, Exception):
+            print(f"Scraping failed: {str(outcome)}")
+            response, status_code = {"error": str(outcome), "status": "failed"}, 500
+        else:
+            response, status_code, _ = outcome
+        results.append(dict(response, website_url=website_url, status_code=status_code))
+    return jsonify({"status": "success", "results": results}), 200
+
+@app.route('/metrics')
+@require_webhook_key
+def metrics():
+    return jsonify({"fetch": fetch_stats(), "cache": cache.stats(), "negative_cache": negative_cache.stats()}), 200
+
+@app.route('/admin/breakers')
+@require_webhook_key
+def admin_breakers():
+    return jsonify({"breakers": breaker_stats()}), 200
+
+@app.route('/admin/proxies')
+@require_webhook_key
+def admin_proxies():
+    return jsonify({"proxies": proxy_stats()}), 200
 
 @app.route('/')
 def home():
@@ -142,6 +389,10 @@ def test_validator():
         {"input": {}, "expected": "Missing 'website_url' in the request data."},
         {"input": {"website_url": ""}, "expected": "'website_url' must be a non-empty string."},
         {"input": {"website_url": 123}, "expected": "'website_url' must be a non-empty string."},
+        {"input": {"website_url": "https://www.example.com", "fields": ["title", "meta_description"]}, "expected": None},
+        {"input": {"website_url": "https://www.example.com", "fields": []}, "expected": "'fields' must be a non-empty list of field names."},
+        {"input": {"website_url": "https://www.example.com", "timeout": 5}, "expected": None},
+        {"input": {"website_url": "https://www.example.com", "timeout": 0}, "expected": "'timeout' must be a number of seconds greater than 0 and at most 300."},
     ]
 
     results = []
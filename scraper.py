@@ -1,9 +1,27 @@
+import asyncio
+import codecs
 import logging
+import os
 from bs4 import BeautifulSoup
 import trafilatura
+from trafilatura.metadata import extract_metadata
+from trafilatura.settings import use_config
+from trafilatura.utils import load_html
+from charset_normalizer import from_bytes
+from lxml import etree
+import multiprocessing
+import queue
 import random
+import threading
 import requests
 import re
+from fetcher import BREAKERS, DOMAIN_CONCURRENCY, SCHEDULER, SESSIONS, STATS, CircuitOpenError, SlotTimeout, is_dns_failure, url_domain
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from time import monotonic, sleep
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlsplit
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -16,51 +34,872 @@ USER_AGENTS = [
     'Mozilla/5.0 (iPhone; CPU iPhone OS 14_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Mobile/15E148 Safari/604.1'
 ]
 
+# Fields scrape_website can return, in response order. The metadata fields
+# are only computed when asked for.
+DEFAULT_FIELDS = ('title', 'meta_description', 'h1_tags', 'links', 'main_content', 'pages_count')
+METADATA_FIELDS = ('author', 'date', 'sitename', 'canonical', 'image')
+FIELDS = DEFAULT_FIELDS + METADATA_FIELDS
+HEAD_FIELDS = ('title', 'meta_description')
+# Fields from stages whose failure still leaves a usable result: they come
+# back as None, with the reason under "errors", and the result is partial
+OPTIONAL_FIELDS = METADATA_FIELDS + ('main_content',)
+# htmldate's extensive search scans the whole document text for dates; the
+# metadata stage sticks to markup and URL patterns unless asked otherwise
+DATE_EXTENSIVE_SEARCH = False
+
+# Elements the field collector has to visit for each field; only the tags of
+# the requested fields are walked, in a single tree.iter() pass
+FIELD_TAGS = {
+    'title': ('title',),
+    'meta_description': ('meta',),
+    'h1_tags': ('h1',),
+    'links': ('base', 'a'),
+    'pages_count': ('base', 'a')
+}
+
+# trafilatura settings per extraction tier. 'fast' skips the readability and
+# justext comparison in compare_extraction, 'precise' keeps it and prunes
+# doubtful sections. No tier sets max_tree_size: trafilatura applies it to
+# the finished output and throws long articles away without saving any
+# time. Extraction time is bounded by the 'extract' stage deadline instead
+# (see EXTRACTION_INLINE_BYTES).
+EXTRACTION_MODES = {
+    'fast': {'no_fallback': True},
+    'balanced': {'no_fallback': False},
+    'precise': {'no_fallback': False, 'favor_precision': True}
+}
+DEFAULT_EXTRACTION_MODE = 'balanced'
+
+# trafilatura's own EXTRACTION_TIMEOUT relies on SIGALRM, which only works in
+# the main thread; it is switched off in favour of the stage deadlines below
+EXTRACTION_CONFIG = use_config()
+EXTRACTION_CONFIG.set('DEFAULT', 'EXTRACTION_TIMEOUT', '0')
+
+# Per-stage time budgets in seconds, enforced from any thread
+STAGE_TIMEOUTS = {
+    'fetch': 10,
+    'parse': 5,
+    'extract': 10
+}
+# Only transient fetch failures are retried, after an exponential backoff
+# with full jitter, or after the server's Retry-After if that is shorter
+# than RETRY_AFTER_MAX (otherwise the fetch fails straight away)
+RETRYABLE_STATUSES = frozenset((408, 425, 429, 500, 502, 503, 504))
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 8.0
+RETRY_AFTER_MAX = 30.0
+# Bodies are streamed and cut off after this many bytes (trafilatura's
+# MAX_FILE_SIZE by default); the response is then flagged as truncated
+MAX_CONTENT_BYTES = int(os.environ.get('SCRAPER_MAX_BYTES', 20000000))
+CHUNK_SIZE = 64 * 1024
+# Floor for the socket timeout handed to requests, in seconds
+MIN_REQUEST_TIMEOUT = 0.01
+# Charset detection: the <meta charset> sniff only looks at the start of the
+# document, and statistical detection only runs on a bounded prefix
+CHARSET_SNIFF_BYTES = 8 * 1024
+CHARSET_DETECTION_BYTES = 64 * 1024
+# The detection prefix is cut on a character boundary found in its last
+# CHARSET_BOUNDARY_SCAN_BYTES (see detect_prefix)
+CHARSET_BOUNDARY_SCAN_BYTES = 4 * 1024
+HIGH_BYTES = bytes(range(0x80, 0x100))
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([A-Za-z0-9._:-]+)', re.I)
+BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16')
+)
+
+# Content gate: these media types are scraped as-is; the sniffed ones are
+# often mislabelled HTML, so their first bytes decide. Anything else is
+# rejected before the body is read.
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+SNIFFED_CONTENT_TYPES = ('', 'text/plain', 'application/octet-stream', 'binary/octet-stream')
+BINARY_SIGNATURES = (
+    b'%PDF', b'PK\x03\x04', b'\x89PNG', b'GIF8', b'\xff\xd8\xff', b'RIFF', b'\x1f\x8b',
+    b'ID3', b'OggS', b'fLaC', b'%!PS', b'7z\xbc\xaf', b'Rar!', b'\x1a\x45\xdf\xa3', b'BM'
+)
+
+# Head-only requests stop reading once </head> is parsed, or after this many
+# bytes when the head never closes
+HEAD_SCAN_BYTES = 512 * 1024
+
+# Main content is extracted from the shared tree in the request thread. That
+# path is NOT bounded by the deadline, which is only checked after
+# trafilatura returns, so documents of EXTRACTION_INLINE_BYTES or more, and
+# documents that recent extraction speed says would not finish within the
+# stage's remaining budget, go to a small pool of worker processes instead.
+# A worker that runs out of budget is killed rather than pinning the web
+# worker, at the cost of re-parsing the HTML there.
+EXTRACTION_WORKERS = int(os.environ.get('SCRAPER_EXTRACTION_WORKERS', 2))
+EXTRACTION_INLINE_BYTES = int(os.environ.get('SCRAPER_EXTRACTION_INLINE_BYTES', 1024 * 1024))
+
+# Async engine limits: scrapes in flight per worker, and per target domain.
+# The fetch layer's DomainScheduler already lets only DOMAIN_CONCURRENCY
+# fetches per domain run at once, so the per-domain limit defaults to that;
+# a higher one would only park pool threads in the scheduler.
+ASYNC_CONCURRENCY = int(os.environ.get('SCRAPER_ASYNC_CONCURRENCY', 20))
+ASYNC_HOST_CONCURRENCY = int(os.environ.get('SCRAPER_ASYNC_HOST_CONCURRENCY', DOMAIN_CONCURRENCY))
+
+# 'lxml' reads the shared tree; 'bs4' is the original html.parser path,
+# kept as a fallback and for parity checks
+FIELD_ENGINES = ('lxml', 'bs4')
+
 class ScrapingError(Exception):
     pass
 
-def fetch_html(url):
+class DeadlineExceeded(ScrapingError):
+    def __init__(self, stage, timeout):
+        super().__init__(f"{stage} stage exceeded its {timeout:g}s deadline")
+        self.stage = stage
+        self.timeout = timeout
+
+class FetchError(ScrapingError):
+    # kind is 'http', 'dns', 'timeout', 'connection', 'proxy', 'invalid' or
+    # 'circuit_open' (the domain's breaker is failing fast); status is
+    # set for HTTP errors, retry_after (seconds) when the server asked for it
+    def __init__(self, message, kind, status=None, retryable=False, retry_after=None):
+        super().__init__(message)
+        self.kind = kind
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+class UnsupportedContentError(ScrapingError):
+    # The target is not an HTML document; retrying will not change that
+    pass
+
+class NotModified(Exception):
+    # A conditional fetch got 304: the caller's cached result is still current
+    pass
+
+class Deadline:
+    """Monotonic time budget for one pipeline stage.
+
+    A stage deadline clipped to what was left of an outer one (its parent)
+    reports running out as the outer deadline running out.
+    """
+
+    def __init__(self, stage, timeout, parent=None):
+        self.stage = stage
+        self.timeout = timeout
+        self.parent = parent
+        self.expires = monotonic() + timeout
+
+    def remaining(self):
+        return max(0.0, self.expires - monotonic())
+
+    def expired(self):
+        return monotonic() >= self.expires
+
+    def check(self):
+        if self.expired():
+            raise self.exceeded()
+
+    def exceeded(self):
+        # The error to raise once this deadline has passed
+        if self.parent is not None:
+            return self.parent.exceeded()
+        return DeadlineExceeded(self.stage, self.timeout)
+
+    def stage_deadline(self, stage, timeout):
+        # A stage inside this deadline gets its own timeout or whatever is
+        # left here, whichever is shorter
+        self.check()
+        remaining = self.remaining()
+        if remaining < timeout:
+            return Deadline(stage, remaining, parent=self)
+        return Deadline(stage, timeout)
+
+class FetchedPage:
+    def __init__(self, url, html, truncated=False, validators=None, encoding_source=None):
+        self.url = url
+        self.html = html
+        self.truncated = truncated
+        self.validators = validators or {}
+        # Which detect_charset step picked the encoding
+        self.encoding_source = encoding_source
+
+def fetch_html(url, deadline=None, max_bytes=MAX_CONTENT_BYTES):
+    return fetch_page(url, deadline, max_bytes).html
+
+def open_response(url, deadline, validators=None):
     headers = {'User-Agent': random.choice(USER_AGENTS)}
+    headers.update(conditional_headers(validators))
+    logger.info(f"Fetching HTML for {url}")
+    # The budget can run out while waiting for a fetch slot, and urllib3
+    # rejects a zero timeout outright
+    deadline.check()
+    timeout = max(deadline.remaining(), MIN_REQUEST_TIMEOUT)
+    response = SESSIONS.get(url, headers=headers, timeout=timeout, stream=True)
+    if response.status_code == 304 and validators:
+        response.close()
+        logger.info(f"{url} not modified")
+        raise NotModified(url)
     try:
-        logger.info(f"Fetching HTML for {url}")
-        response = requests.get(url, headers=headers, timeout=10)
         response.raise_for_status()
-        return response.text
+        check_content_type(url, response)
+    except (requests.HTTPError, UnsupportedContentError):
+        response.close()
+        raise
+    return response
+
+def check_content_type(url, response):
+    media_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if media_type not in HTML_CONTENT_TYPES and media_type not in SNIFFED_CONTENT_TYPES:
+        logger.warning(f"Rejecting {url}: Content-Type {media_type}")
+        raise UnsupportedContentError(f"Unsupported content type: {media_type}")
+
+def check_first_bytes(chunk):
+    # Byte signatures of the binary formats users most often submit, and NUL
+    # bytes, which HTML in an ASCII-compatible encoding never contains
+    start = chunk[:1024]
+    if start.startswith(BINARY_SIGNATURES) or start[4:8] == b'ftyp':
+        raise UnsupportedContentError("Unsupported content: binary file signature")
+    if b'\x00' in start and not start.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        raise UnsupportedContentError("Unsupported content: binary data")
+
+def conditional_headers(validators):
+    headers = {}
+    if validators and validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators and validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+def response_validators(response):
+    return {
+        key: value for key, value in (
+            ('etag', response.headers.get('ETag')),
+            ('last_modified', response.headers.get('Last-Modified'))
+        ) if value
+    }
+
+def fetch_page(url, deadline=None, max_bytes=MAX_CONTENT_BYTES, validators=None):
+    deadline = deadline or Deadline('fetch', STAGE_TIMEOUTS['fetch'])
+    try:
+        with SCHEDULER.slot(url, deadline.remaining()):
+            response = open_response(url, deadline, validators)
+            try:
+                body, truncated = read_body(response, deadline, max_bytes)
+            finally:
+                # Closing without draining drops whatever is left of an
+                # oversized body instead of downloading it
+                response.close()
+        if truncated:
+            logger.warning(f"Truncated {url} at {max_bytes} bytes")
+        html, encoding_source = decode_body(body, response.headers.get('Content-Type', ''))
+        return FetchedPage(url, html, truncated, response_validators(response), encoding_source)
+    except SlotTimeout as e:
+        raise deadline.exceeded() from e
     except requests.RequestException as e:
         logger.error(f"Failed to fetch HTML for {url}: {str(e)}")
-        raise ScrapingError(f"Request failed: {str(e)}")
+        raise classify_request_error(e) from e
 
-def scrape_website(url, max_retries=3):
-    logger.info(f"Scraping website: {url}")
+def classify_request_error(error):
+    message = f"Request failed: {str(error)}"
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        retry_after = parse_retry_after(error.response.headers.get('Retry-After'))
+        return FetchError(message, 'http', status, status in RETRYABLE_STATUSES, retry_after)
+    if isinstance(error, requests.exceptions.ProxyError):
+        # Another proxy from the pool may get through
+        return FetchError(message, 'proxy', retryable=True)
+    if isinstance(error, requests.Timeout):
+        return FetchError(message, 'timeout', retryable=True)
+    if isinstance(error, (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema,
+                          requests.exceptions.InvalidSchema, requests.TooManyRedirects)):
+        return FetchError(message, 'invalid')
+    if is_dns_failure(error):
+        return FetchError(message, 'dns')
+    return FetchError(message, 'connection', retryable=True)
+
+def is_host_failure(error):
+    # Whether a failed fetch says the target host is down or broken, for the
+    # circuit breaker. Client errors mean it answered; proxy errors are the
+    # proxy pool's business. None means the failure says nothing about the
+    # host: waiting on our own politeness limit, or the caller's deadline.
+    while isinstance(error, FetchError) and isinstance(error.__cause__, (FetchError, DeadlineExceeded)):
+        # Look through fetch_with_retries' summary to the last attempt
+        error = error.__cause__
+    if isinstance(error, DeadlineExceeded):
+        if error.stage == 'request' or isinstance(error.__cause__, SlotTimeout):
+            return None
+        # A response too slow to finish within the fetch stage
+        return True
+    if isinstance(error, FetchError):
+        if error.kind == 'http':
+            return error.status is not None and error.status >= 500
+        return error.kind in ('timeout', 'connection', 'dns')
+    return False
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+def retry_delay(attempt, retry_after=None):
+    # None means the server wants us to wait longer than is worth waiting
+    if retry_after is not None:
+        return retry_after if retry_after <= RETRY_AFTER_MAX else None
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** (attempt - 1)))
+
+def fetch_with_retries(url, fetch, max_retries=3, deadline=None):
+    # Calls fetch() until it succeeds or fails in a way retrying won't fix.
+    # A fetch that runs out of time counts as a retryable timeout, unless
+    # the overall deadline is what ran out.
+    for attempt in range(1, max_retries + 1):
+        try:
+            return fetch()
+        except (FetchError, DeadlineExceeded) as e:
+            if deadline is not None:
+                deadline.check()
+            retryable = isinstance(e, DeadlineExceeded) or e.retryable
+            if not retryable:
+                raise
+            if attempt == max_retries:
+                logger.error(f"Failed to fetch {url} after {max_retries} attempts.")
+                raise FetchError(
+                    f"Failed to scrape website after {max_retries} attempts: {str(e)}",
+                    getattr(e, 'kind', 'timeout'), getattr(e, 'status', None), retryable=True,
+                    retry_after=getattr(e, 'retry_after', None)
+                ) from e
+            delay = retry_delay(attempt, getattr(e, 'retry_after', None))
+            if delay is None:
+                raise
+            if deadline is not None and delay >= deadline.remaining():
+                logger.warning(f"No time left to retry {url}")
+                raise deadline.exceeded() from e
+            logger.warning(f"Fetch attempt {attempt} for {url} failed: {str(e)}. Retrying in {delay:.2f}s...")
+            STATS.increment('fetch_retries')
+            sleep(delay)
+
+def fetch_head(url, deadline=None, fields=HEAD_FIELDS, validators=None):
+    # Feeds the body into an incremental parser and hangs up as soon as the
+    # head is complete, so head-only fields never wait for the whole page.
+    # Returns the head fields and the response's cache validators.
+    deadline = deadline or Deadline('fetch', STAGE_TIMEOUTS['fetch'])
+    try:
+        with SCHEDULER.slot(url, deadline.remaining()):
+            response = open_response(url, deadline, validators)
+            try:
+                head = read_head(response, deadline)
+            finally:
+                response.close()
+    except SlotTimeout as e:
+        raise deadline.exceeded() from e
+    except requests.RequestException as e:
+        logger.error(f"Failed to fetch HTML for {url}: {str(e)}")
+        raise classify_request_error(e) from e
+    return extract_fields(head, url, fields), response_validators(response)
+
+def read_head(response, deadline):
+    parser = None
+    received = 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        if not chunk:
+            continue
+        if parser is None:
+            check_first_bytes(chunk)
+            # Statistical detection is skipped here: libxml2 does its own
+            # sniffing when no encoding is given.
+            # No tag filter on the parser: it does not report implicitly
+            # closed heads.
+            encoding, _ = detect_charset(chunk, response.headers.get('Content-Type', ''), statistical=False)
+            parser = etree.HTMLPullParser(events=('end',), encoding=encoding, remove_comments=True)
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            if element.tag == 'head':
+                return element
+        received += len(chunk)
+        if received > HEAD_SCAN_BYTES:
+            break
+        deadline.check()
+    # No </head> event: the head never closed, or libxml2 dropped the events
+    # (it does when a <meta charset> is split across two feeds). Whatever
+    # was parsed so far still holds the head.
+    try:
+        if parser is None:
+            raise etree.ParserError("empty document")
+        return parser.close()
+    except etree.LxmlError:
+        raise ScrapingError("Could not parse HTML document")
+
+def known_encoding(name):
+    try:
+        return codecs.lookup(name).name
+    except (LookupError, TypeError):
+        return None
+
+def detect_charset(body, content_type, statistical=True):
+    # Cheapest evidence first: the Content-Type charset, a BOM, a <meta>
+    # declaration near the top, and only then charset_normalizer on a prefix.
+    # Returns the encoding and the step that found it.
+    match = re.search(r'charset=["\']?([\w.:-]+)', content_type, re.I)
+    if match and known_encoding(match.group(1)):
+        return match.group(1), 'header'
+    for bom, encoding in BOMS:
+        if body.startswith(bom):
+            return encoding, 'bom'
+    match = META_CHARSET_RE.search(body[:CHARSET_SNIFF_BYTES])
+    if match and known_encoding(match.group(1).decode('ascii')):
+        return match.group(1).decode('ascii'), 'meta'
+    if statistical and body:
+        best = detect_prefix(body)
+        if best:
+            # An ASCII-only prefix (a big inline script or stylesheet, say)
+            # says nothing about the rest; utf-8 decodes it the same way
+            if known_encoding(best.encoding) == 'ascii':
+                return 'utf-8', 'detected'
+            return best.encoding, 'detected'
+    return None, 'default'
+
+def detect_prefix(body):
+    # charset_normalizer misreads or gives up on a sample that ends inside a
+    # multi-byte character. Any byte below 0x80 ends a character in UTF-8
+    # and the double-byte encodings (Shift_JIS, GBK, Big5...), so the prefix
+    # is cut after the last one near its end. Without one, each of the 4
+    # possible cuts is tried and the most plausible reading wins.
+    if len(body) <= CHARSET_DETECTION_BYTES:
+        return from_bytes(body).best()
+    prefix = body[:CHARSET_DETECTION_BYTES]
+    end = len(prefix) - CHARSET_BOUNDARY_SCAN_BYTES + len(prefix[-CHARSET_BOUNDARY_SCAN_BYTES:].rstrip(HIGH_BYTES))
+    if end > len(prefix) - CHARSET_BOUNDARY_SCAN_BYTES:
+        return from_bytes(prefix[:end]).best()
+    candidates = [from_bytes(prefix[:len(prefix) - drop]).best() for drop in range(4)]
+    candidates = [best for best in candidates if best]
+    return min(candidates, key=lambda best: (best.chaos, -best.coherence)) if candidates else None
+
+def read_body(response, deadline, max_bytes):
+    declared = response.headers.get('Content-Length', '')
+    if declared.isdigit() and int(declared) > max_bytes:
+        logger.warning(f"Content-Length {declared} exceeds {max_bytes} bytes, reading only the first {max_bytes}")
+    body = bytearray()
+    for chunk in response.iter_content(CHUNK_SIZE):
+        if not body and chunk:
+            check_first_bytes(chunk)
+        body += chunk
+        if len(body) > max_bytes:
+            return bytes(body[:max_bytes]), True
+        deadline.check()
+    return bytes(body), False
+
+def decode_body(body, content_type=''):
+    encoding, source = detect_charset(body, content_type)
+    STATS.increment(f'charset_{source}')
+    return str(body, encoding or 'utf-8', errors='replace'), source
+
+def parse_html(html, deadline=None):
+    # One lxml tree per page: the field extractors read it first, then it is
+    # handed to trafilatura, which would otherwise re-parse the raw string.
+    # libxml2 cannot be interrupted, so the deadline is checked on return.
+    tree = load_html(html)
+    if tree is None:
+        raise ScrapingError("Could not parse HTML document")
+    if deadline:
+        deadline.check()
+    return tree
 
-    for attempt in range(max_retries):
+def collect_fields(tree, base_url=None, fields=FIELDS):
+    # Walks the tree once and emits the head fields, h1s, links and the set
+    # of internal pages together, resolving each distinct internal href once.
+    tags = set(tag for field in fields for tag in FIELD_TAGS.get(field, ()))
+    scope = tree
+    if set(fields) <= set(HEAD_FIELDS):
+        head = tree.find('head')
+        scope = head if head is not None else tree
+    want_links = 'links' in fields
+    title = description = None
+    h1_tags, links, internal_hrefs = [], [], set()
+    for element in scope.iter(tuple(tags)) if tags else ():
+        tag = element.tag
+        if tag == 'a':
+            href = element.get('href')
+            if href is None:
+                continue
+            if want_links:
+                links.append({"text": str(element.text_content()), "href": href})
+            if is_internal_href(href):
+                internal_hrefs.add(href)
+        elif tag == 'h1':
+            h1_tags.append(str(element.text_content()))
+        elif tag == 'meta':
+            if description is None and element.get('name') == 'description':
+                description = element.get('content', "No meta description found")
+        elif tag == 'title':
+            if title is None:
+                title = element
+        elif tag == 'base' and element.get('href'):
+            base_url = urljoin(base_url or '', element.get('href'))
+    return {
+        "title": title.text if title is not None else "No title found",
+        "meta_description": description if description is not None else "No meta description found",
+        "h1_tags": h1_tags,
+        "links": links,
+        "internal_pages": set(resolve_href(base_url, href) for href in internal_hrefs)
+    }
+
+def extract_fields(tree, base_url=None, fields=FIELDS):
+    collected = collect_fields(tree, base_url, fields)
+    internal_pages = collected.pop("internal_pages")
+    collected["pages_count"] = len(internal_pages) + 1 if internal_pages else 1
+    return {field: collected[field] for field in fields if field in collected}
+
+CANONICAL_XPATH = etree.XPath('//head/link[@rel="canonical"]/@href')
+BASE_HREF_XPATH = etree.XPath('//head/base/@href')
+
+def extract_page_metadata(tree, url=None, fields=METADATA_FIELDS, extensive_search=DATE_EXTENSIVE_SEARCH):
+    # Reads the shared tree; must run before trafilatura cleans it. The date
+    # config is built per call since trafilatura writes the URL into it.
+    date_config = {'extensive_search': extensive_search, 'original_date': True}
+    metadata = extract_metadata(tree, date_config=date_config, fastmode=True)
+    # trafilatura drops relative canonical hrefs unless an og: or twitter:
+    # tag names the domain, so the link is read here first
+    base_url = url
+    for href in BASE_HREF_XPATH(tree)[:1]:
+        base_url = urljoin(url or '', href.strip())
+    canonical = next((href.strip() for href in CANONICAL_XPATH(tree) if href.strip()), None)
+    canonical = canonical or (metadata.url if metadata else None)
+    image = metadata.image if metadata else None
+    values = {
+        "author": metadata.author if metadata else None,
+        "date": metadata.date if metadata else None,
+        "sitename": metadata.sitename if metadata else None,
+        "canonical": urljoin(base_url, canonical) if base_url and canonical else canonical,
+        "image": urljoin(base_url, image) if base_url and image else image
+    }
+    return {field: values[field] for field in fields if field in values}
+
+def extract_fields_bs4(html, base_url=None):
+    soup = BeautifulSoup(html, 'html.parser')
+    description = soup.find("meta", attrs={"name": "description"})
+    base = soup.find("base", href=True)
+    if base and base["href"]:
+        base_url = urljoin(base_url or '', base["href"])
+    return {
+        "title": soup.title.string if soup.title else "No title found",
+        "meta_description": description.get("content", "No meta description found") if description else "No meta description found",
+        "h1_tags": [h1.text for h1 in soup.find_all("h1")],
+        "links": [{"text": a.text, "href": a.get("href")} for a in soup.find_all("a", href=True)],
+        "pages_count": count_pages(soup, base_url)
+    }
+
+def extract_main_content(tree, url=None, extraction_mode=DEFAULT_EXTRACTION_MODE):
+    # trafilatura cleans the tree in place, so this must run after the
+    # field extractors
+    main_content = trafilatura.extract(tree, url=url, config=EXTRACTION_CONFIG, **EXTRACTION_MODES[extraction_mode])
+    return main_content if main_content else "No main content extracted"
+
+def _extraction_loop(connection, parent_connection, parent_pid):
+    # Serves (html, url, extraction_mode) jobs until the pipe is closed or
+    # the web worker that started it is gone. The worker re-parses the HTML
+    # since lxml trees cannot be pickled.
+    if parent_connection is not None:
+        # A forked worker inherits the web worker's end of its own pipe,
+        # which would keep recv() from ever seeing EOF
+        parent_connection.close()
+    while True:
+        try:
+            # Later workers inherit earlier workers' pipe ends as well, so
+            # EOF alone can't be relied on: also check for a new parent
+            while not connection.poll(1):
+                if os.getppid() != parent_pid:
+                    return
+            html, url, extraction_mode = connection.recv()
+        except EOFError:
+            return
         try:
-            html = fetch_html(url)
-            soup = BeautifulSoup(html, 'html.parser')
-            main_content = trafilatura.extract(html)
-
-            scraped_data = {
-                "url": url,
-                "title": soup.title.string if soup.title else "No title found",
-                "meta_description": soup.find("meta", attrs={"name": "description"})["content"] if soup.find("meta", attrs={"name": "description"}) else "No meta description found",
-                "h1_tags": [h1.text for h1 in soup.find_all("h1")],
-                "links": [{"text": a.text, "href": a.get("href")} for a in soup.find_all("a", href=True)],
-                "main_content": main_content if main_content else "No main content extracted",
-                "pages_count": count_pages(soup)
-            }
-
-            return scraped_data
+            result = (True, extract_main_content(parse_html(html), url, extraction_mode))
         except Exception as e:
-            logger.warning(f"Scraping attempt {attempt + 1} failed: {str(e)}. Retrying...")
-            if attempt == max_retries - 1:
-                logger.error(f"Failed to scrape website after {max_retries} attempts.")
-                raise ScrapingError(f"Failed to scrape website after {max_retries} attempts: {str(e)}")
-
-def count_pages(soup):
-    internal_links = soup.find_all('a', href=lambda href: href and not href.startswith(('http', 'www')) and href != '#')
-    valid_links = set(link['href'] for link in internal_links if 'href' in link.attrs and link['href'].strip() != '')
+            result = (False, str(e))
+        connection.send(result)
+
+class ExtractionWorker:
+    def __init__(self, context):
+        self.connection, child = context.Pipe()
+        inherited = self.connection if context.get_start_method() == 'fork' else None
+        self.process = context.Process(target=_extraction_loop, args=(child, inherited, os.getpid()), daemon=True)
+        self.process.start()
+        child.close()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+class ExtractionPool:
+    """Persistent extraction processes, killed and replaced when a job overruns.
+
+    Workers start on first use and are reused across documents; one that
+    misses its deadline is killed and a fresh one takes its place on the next
+    job. Workers belong to the process that started them, so a forked web
+    worker starts its own, and exit when it does.
+
+    The pool also tracks how fast inline extraction runs, so callers can
+    tell which documents would not finish within their budget.
+    """
+
+    def __init__(self, size=EXTRACTION_WORKERS, inline_bytes=EXTRACTION_INLINE_BYTES):
+        self.size = size
+        self.inline_bytes = inline_bytes
+        self._context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+        self._lock = threading.Lock()
+        self._pid = None
+        self._seconds_per_byte = None
+
+    def isolate(self, size, deadline):
+        # Whether a document should be extracted in a worker process
+        if size >= self.inline_bytes:
+            return True
+        rate = self._seconds_per_byte
+        return rate is not None and size * rate > deadline.remaining()
+
+    def record_inline(self, size, elapsed):
+        if size:
+            rate = elapsed / size
+            with self._lock:
+                self._seconds_per_byte = rate if self._seconds_per_byte is None else 0.2 * rate + 0.8 * self._seconds_per_byte
+
+    def _reset(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._idle = queue.LifoQueue()
+                self._slots = threading.BoundedSemaphore(self.size)
+
+    def _take(self):
+        try:
+            worker = self._idle.get_nowait()
+        except queue.Empty:
+            return ExtractionWorker(self._context)
+        if worker.process.is_alive():
+            return worker
+        worker.kill()
+        return ExtractionWorker(self._context)
+
+    def extract(self, html, url, extraction_mode, deadline):
+        self._reset()
+        slots = self._slots
+        if not slots.acquire(timeout=deadline.remaining()):
+            raise deadline.exceeded()
+        worker = None
+        try:
+            worker = self._take()
+            worker.connection.send((html, url, extraction_mode))
+            if not worker.connection.poll(deadline.remaining()):
+                logger.warning(f"Killing extraction for {url} after {deadline.timeout:g}s")
+                STATS.increment('extraction_kills')
+                worker.kill()
+                worker = None
+                raise deadline.exceeded()
+            ok, result = worker.connection.recv()
+        except (EOFError, OSError):
+            if worker is not None:
+                worker.kill()
+                worker = None
+            raise ScrapingError("Extraction process exited without a result")
+        finally:
+            if worker is not None:
+                self._idle.put(worker)
+            slots.release()
+        if not ok:
+            raise ScrapingError(f"Extraction failed: {result}")
+        return result
+
+EXTRACTION_POOL = ExtractionPool()
+
+def run_optional_stage(url, stage_fields, errors, stage):
+    # Runs stage(), which returns a dict of stage_fields. If it fails, the
+    # error is recorded against each of those fields and they come back as None.
+    try:
+        return stage()
+    except Exception as e:
+        logger.warning(f"Optional stage for {', '.join(stage_fields)} failed on {url}: {str(e)}")
+        errors.update((field, str(e)) for field in stage_fields)
+        return dict.fromkeys(stage_fields)
+
+def scrape_website(url, max_retries=3, engine='lxml', fields=None, extraction_mode=DEFAULT_EXTRACTION_MODE, timeouts=None, validators=None, deadline=None):
+    # With validators from an earlier result ({'etag': ..., 'last_modified': ...})
+    # the fetch is conditional and raises NotModified on a 304. Fresh results
+    # carry the page's own validators under "validators". A failed
+    # OPTIONAL_FIELDS stage makes the result partial rather than failing it
+    # (see run_optional_stage). An overall deadline
+    # caps every stage and retry; once it has passed, DeadlineExceeded is
+    # raised instead of starting more work.
+    logger.info(f"Scraping website: {url}")
+    if engine not in FIELD_ENGINES:
+        raise ValueError(f"Unknown field engine: {engine}")
+    if extraction_mode not in EXTRACTION_MODES:
+        raise ValueError(f"Unknown extraction mode: {extraction_mode}")
+    fields = [field for field in FIELDS if field in (fields or DEFAULT_FIELDS)]
+    timeouts = dict(STAGE_TIMEOUTS, **(timeouts or {}))
+
+    head_only = engine == 'lxml' and set(fields) <= set(HEAD_FIELDS)
+
+    def stage_deadline(stage):
+        if deadline is None:
+            return Deadline(stage, timeouts[stage])
+        return deadline.stage_deadline(stage, timeouts[stage])
+
+    def fetch():
+        if head_only:
+            return fetch_head(url, stage_deadline('fetch'), fields, validators)
+        return fetch_page(url, stage_deadline('fetch'), validators=validators)
+
+    # Only the fetch is retried: the later stages would see the same bytes.
+    # The breaker sees the fetch and its retries as one outcome.
+    try:
+        with BREAKERS.guard(url, is_host_failure):
+            fetched = fetch_with_retries(url, fetch, max_retries, deadline)
+    except CircuitOpenError as e:
+        raise FetchError(str(e), 'circuit_open', retry_after=e.retry_in)
+    if head_only:
+        extracted, page_validators = fetched
+        scraped_data = {"url": url, "truncated": False, "partial": False}
+        scraped_data.update((field, extracted[field]) for field in fields)
+        scraped_data["validators"] = page_validators
+        return scraped_data
+
+    page = fetched
+    html = page.html
+    try:
+        tree = parse_html(html, stage_deadline('parse'))
+        if engine == 'lxml':
+            extracted = extract_fields(tree, url, fields)
+        else:
+            extracted = extract_fields_bs4(html, url)
+    except ScrapingError:
+        raise
+    except Exception as e:
+        logger.exception(f"Failed to process {url}")
+        raise ScrapingError(f"Failed to process website: {str(e)}") from e
+
+    def extract_content():
+        extract_deadline = stage_deadline('extract')
+        if EXTRACTION_POOL.isolate(len(html), extract_deadline):
+            STATS.increment('isolated_extractions')
+            return {"main_content": EXTRACTION_POOL.extract(html, url, extraction_mode, extract_deadline)}
+        # Inline extraction cannot be interrupted; keep the result even if
+        # it came in late rather than throwing finished work away
+        start = monotonic()
+        main_content = extract_main_content(tree, url, extraction_mode)
+        EXTRACTION_POOL.record_inline(len(html), monotonic() - start)
+        if extract_deadline.expired():
+            logger.warning(f"Inline extraction for {url} overran its {extract_deadline.timeout:g}s budget")
+        return {"main_content": main_content}
+
+    errors = {}
+    metadata_fields = [field for field in fields if field in METADATA_FIELDS]
+    if metadata_fields:
+        extracted.update(run_optional_stage(url, metadata_fields, errors, lambda: extract_page_metadata(tree, url, fields)))
+    if 'main_content' in fields:
+        extracted.update(run_optional_stage(url, ['main_content'], errors, extract_content))
+
+    scraped_data = {"url": url, "truncated": page.truncated, "partial": bool(errors)}
+    scraped_data.update((field, extracted[field]) for field in fields)
+    if errors:
+        scraped_data["errors"] = errors
+    scraped_data["validators"] = page.validators
+    return scraped_data
+
+_async_executor = None
+_async_executor_lock = threading.Lock()
+
+def async_executor():
+    # One bounded thread pool per worker process, shared by every engine
+    global _async_executor
+    with _async_executor_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(ASYNC_CONCURRENCY, thread_name_prefix='scraper-async')
+        return _async_executor
+
+class AsyncFetchEngine:
+    """Runs many scrapes concurrently from one event loop.
+
+    requests has no async transport, so each job runs on a shared thread
+    pool over the keep-alive session pool while the loop only awaits it.
+    A global semaphore caps jobs in flight and a per-domain one caps how
+    many of them target the same domain, matching the fetch layer's
+    DomainScheduler so same-domain jobs wait here instead of holding a pool
+    thread. Create it inside the running loop.
+    """
+
+    def __init__(self, concurrency=ASYNC_CONCURRENCY, host_concurrency=ASYNC_HOST_CONCURRENCY):
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self._global = asyncio.Semaphore(concurrency)
+        self._hosts = {}
+
+    def _host_semaphore(self, url):
+        domain = url_domain(url)
+        if domain not in self._hosts:
+            self._hosts[domain] = asyncio.Semaphore(self.host_concurrency)
+        return self._hosts[domain]
+
+    async def run(self, url, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        async with self._global, self._host_semaphore(url):
+            return await loop.run_in_executor(async_executor(), lambda: func(*args, **kwargs))
+
+async def scrape_website_async(url, fetch_engine=None, **kwargs):
+    fetch_engine = fetch_engine or AsyncFetchEngine()
+    return await fetch_engine.run(url, scrape_website, url, **kwargs)
+
+async def run_many_async(urls, func, *args, fetch_engine=None, **kwargs):
+    # Runs func(url, *args, **kwargs) for every URL on the engine. Results
+    # come back in input order; a failed URL yields its exception.
+    fetch_engine = fetch_engine or AsyncFetchEngine()
+    return await asyncio.gather(*(fetch_engine.run(url, func, url, *args, **kwargs) for url in urls), return_exceptions=True)
+
+def run_many(urls, func, *args, **kwargs):
+    return asyncio.run(run_many_async(urls, func, *args, **kwargs))
+
+async def scrape_many_async(urls, fetch_engine=None, **kwargs):
+    return await run_many_async(urls, scrape_website, fetch_engine=fetch_engine, **kwargs)
+
+def scrape_many(urls, **kwargs):
+    return asyncio.run(scrape_many_async(urls, **kwargs))
+
+def count_pages(soup, base_url=None):
+    return count_hrefs([link.get('href') for link in soup.find_all('a', href=True)], base_url)
+
+def count_hrefs(hrefs, base_url=None):
+    valid_links = set(resolve_href(base_url, href) for href in set(hrefs) if is_internal_href(href))
     return len(valid_links) + 1 if valid_links else 1
 
+def is_internal_href(href):
+    return bool(href) and not href.startswith(('http', 'www', '#')) and href.strip() != ''
+
+def resolve_href(base_url, href):
+    # Relative spellings of one page ("about", "/about", "/about#team")
+    # collapse to a single absolute URL
+    href = href.strip()
+    if base_url:
+        origin = url_origin(base_url)
+        if origin and href.startswith('/') and not href.startswith('//') and '/.' not in href:
+            # Root-relative paths are by far the most common; skip urljoin
+            href = origin + href
+        else:
+            href = urljoin(base_url, href)
+    return href.partition('#')[0]
+
+@lru_cache(maxsize=1024)
+def url_origin(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}" if parts.scheme and parts.netloc else None
+
 def test_scraper():
     test_url = "https://example.com"
     try:
@@ -1,3 +1,11 @@
+from scraper import FIELDS, EXTRACTION_MODES
+
+# Longest end-to-end deadline a caller may ask for, in seconds
+MAX_REQUEST_TIMEOUT = 300
+# Most URLs a single batch request may carry
+MAX_BATCH_URLS = 50
+
+
 def validate_input(data):
     """
     Validates the input data for the required parameters.
@@ -21,5 +29,70 @@ def validate_input(data):
     # Additional validation for the URL format can be added here
     # For example, you can check if the URL is valid using regex or urllib
 
+    return validate_options(data)
+
+def validate_batch_input(data):
+    """
+    Validates the input data for a batch request.
+
+    Args:
+        data (dict): The input data from the request.
+
+    Returns:
+        str or None: An error message if validation fails, or None if validation passes.
+    """
+    if not data:
+        return "No data provided."
+
+    if 'website_urls' not in data:
+        return "Missing 'website_urls' in the request data."
+
+    website_urls = data['website_urls']
+    if not isinstance(website_urls, list) or not website_urls or not all(isinstance(url, str) and url.strip() for url in website_urls):
+        return "'website_urls' must be a non-empty list of non-empty strings."
+    if len(website_urls) > MAX_BATCH_URLS:
+        return f"'website_urls' may hold at most {MAX_BATCH_URLS} URLs."
+
+    return validate_options(data)
+
+def validate_options(data):
+    """
+    Validates the optional parameters shared by single and batch requests.
+
+    Args:
+        data (dict): The input data from the request.
+
+    Returns:
+        str or None: An error message if validation fails, or None if validation passes.
+    """
+    if 'fields' in data:
+        fields = data['fields']
+        if not isinstance(fields, list) or not fields or not all(isinstance(field, str) for field in fields):
+            return "'fields' must be a non-empty list of field names."
+        unknown = [field for field in fields if field not in FIELDS]
+        if unknown:
+            return f"Unknown field(s) in 'fields': {', '.join(unknown)}. Valid fields: {', '.join(FIELDS)}."
+
+    extraction_mode = data.get('extraction_mode')
+    if 'extraction_mode' in data and (not isinstance(extraction_mode, str) or extraction_mode not in EXTRACTION_MODES):
+        return f"'extraction_mode' must be one of: {', '.join(EXTRACTION_MODES)}."
+
+    if 'timeout' in data:
+        return validate_timeout(data['timeout'])
+
     return None  # Return None if validation passes
 
+def validate_timeout(timeout):
+    """
+    Validates a caller's end-to-end deadline, from the payload or the X-Request-Timeout header.
+
+    Args:
+        timeout: The deadline in seconds.
+
+    Returns:
+        str or None: An error message if validation fails, or None if validation passes.
+    """
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or not 0 < timeout <= MAX_REQUEST_TIMEOUT:
+        return f"'timeout' must be a number of seconds greater than 0 and at most {MAX_REQUEST_TIMEOUT}."
+    return None
+